@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import Extension, setup, find_packages
 
 setup(
     name='timer',
@@ -8,9 +8,17 @@ setup(
     author_email=('csal@brown.edu'),
     packages=find_packages(include=['timer', 'timer.*']),
     url='https://github.com/camall3n/timer/',
+    ext_modules=[
+        # Optional C fast path; timer falls back to pure Python without it
+        Extension('timer._timer_probe', ['timer/_timer_probe.c'], optional=True),
+    ],
     install_requires=[
         "tabulate",
     ],
+    extras_require={
+        # For Timer.wrap(jit=True)
+        "jit": ["numba"],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: MIT License',
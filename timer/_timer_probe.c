@@ -0,0 +1,138 @@
+/*
+ * Optional C fast path for the probes used by `Timer.wrap()`
+ *
+ * The pure-Python wrapper in timer.py does exactly the same work; this module
+ * only removes the interpreter overhead from it. If the extension fails to
+ * build, timer.py falls back to the pure-Python version.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+/*
+ * Read the clock behind time.perf_counter_ns(), so that durations are the same
+ * whether or not this extension was built
+ */
+static long long
+now_ns(void)
+{
+#if PY_VERSION_HEX >= 0x030D0000
+    PyTime_t t;
+    /* Like time.perf_counter_ns(), this can only fail if the clock is broken */
+    (void)PyTime_PerfCounterRaw(&t);
+    return (long long)t;
+#else
+    /* In nanoseconds, like PyTime_t */
+    return (long long)_PyTime_GetPerfCounter();
+#endif
+}
+
+/* Add `delta` to the int stored at `list[index]` */
+static int
+list_item_add(PyObject *list, Py_ssize_t index, long long delta)
+{
+    PyObject *d = PyLong_FromLongLong(delta);
+    if (d == NULL) {
+        return -1;
+    }
+    PyObject *sum = PyNumber_Add(PyList_GET_ITEM(list, index), d);
+    Py_DECREF(d);
+    if (sum == NULL) {
+        return -1;
+    }
+    /* Steals the reference to `sum` and releases the old item */
+    return PyList_SetItem(list, index, sum);
+}
+
+PyDoc_STRVAR(probe_enter_doc,
+"probe_enter() -> int\n\n"
+"Return the current value of the time.perf_counter_ns() clock.");
+
+static PyObject *
+probe_enter(PyObject *module, PyObject *Py_UNUSED(ignored))
+{
+    return PyLong_FromLongLong(now_ns());
+}
+
+PyDoc_STRVAR(probe_exit_doc,
+"probe_exit(stats_map, tag, start)\n\n"
+"Record one call of `tag` that started at `start` (from probe_enter()).\n\n"
+"`stats_map` maps each tag to a mutable [total_ns, calls] list, as in\n"
+"Timer.stats_map.");
+
+static PyObject *
+probe_exit(PyObject *module, PyObject *const *args, Py_ssize_t nargs)
+{
+    long long end = now_ns();
+
+    if (nargs != 3) {
+        PyErr_Format(PyExc_TypeError,
+                     "probe_exit expected 3 arguments, got %zd", nargs);
+        return NULL;
+    }
+    PyObject *stats_map = args[0];
+    PyObject *tag = args[1];
+    if (!PyDict_Check(stats_map)) {
+        PyErr_SetString(PyExc_TypeError, "stats_map must be a dict");
+        return NULL;
+    }
+    long long start = PyLong_AsLongLong(args[2]);
+    if (start == -1 && PyErr_Occurred()) {
+        return NULL;
+    }
+    long long dt = end - start;
+
+    PyObject *entry = PyDict_GetItemWithError(stats_map, tag);
+    if (entry == NULL) {
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        entry = Py_BuildValue("[Li]", dt, 1);
+        if (entry == NULL) {
+            return NULL;
+        }
+        int err = PyDict_SetItem(stats_map, tag, entry);
+        Py_DECREF(entry);
+        if (err < 0) {
+            return NULL;
+        }
+        Py_RETURN_NONE;
+    }
+    if (!PyList_Check(entry) || PyList_GET_SIZE(entry) < 2) {
+        PyErr_SetString(PyExc_TypeError,
+                        "stats_map values must be [total_ns, calls] lists");
+        return NULL;
+    }
+
+    /* Keep the entry alive even if the dict is modified while adding */
+    Py_INCREF(entry);
+    int err = list_item_add(entry, 0, dt);
+    if (err == 0) {
+        err = list_item_add(entry, 1, 1);
+    }
+    Py_DECREF(entry);
+    if (err < 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef probe_methods[] = {
+    {"probe_enter", probe_enter, METH_NOARGS, probe_enter_doc},
+    {"probe_exit", (PyCFunction)(void (*)(void))probe_exit, METH_FASTCALL,
+     probe_exit_doc},
+    {NULL, NULL, 0, NULL},
+};
+
+static struct PyModuleDef probe_module = {
+    PyModuleDef_HEAD_INIT,
+    "timer._timer_probe",
+    "C fast path for the probes used by Timer.wrap()",
+    -1,
+    probe_methods,
+};
+
+PyMODINIT_FUNC
+PyInit__timer_probe(void)
+{
+    return PyModule_Create(&probe_module);
+}
@@ -1,10 +1,39 @@
+from array import array
 import atexit
-from collections import defaultdict
-from datetime import timedelta
 from functools import wraps
+import inspect
+import math
+import os
+import sys
+import threading
 import time
-
-from tabulate import tabulate
+import warnings
+from weakref import WeakValueDictionary, finalize
+
+try:
+    from timer._timer_probe import probe_enter, probe_exit
+except ImportError:
+    # The C extension is optional; fall back to the pure-Python probes
+    probe_enter = probe_exit = None
+
+# Set TIMER_DISABLED=1 to turn all timers into no-ops
+_ENABLED = os.environ.get('TIMER_DISABLED') != '1'
+
+# The thread that imports timer records into `Timer.stats_map` directly. Every
+# other thread records into its own maps, so that threads never update the
+# same entries; `Timer.stats()` merges them. When a thread ends, its maps are
+# merged into `_finished_maps`.
+_get_ident = threading.get_ident
+_OWNER_IDENT = _get_ident()
+_local = threading.local()
+_thread_maps_lock = threading.RLock()
+# Maps a key for each live thread to its (stats_map, ring_map) pair
+_live_thread_maps = {}
+_finished_maps = ({}, {})
+
+# Wrappers generated by `Timer.wrap()`, so that decorating the same function
+# with the same options again (e.g. on re-import) returns the same wrapper
+_wrap_cache = WeakValueDictionary()
 
 
 def time2str(t, abbr=False):
@@ -13,19 +42,354 @@ def time2str(t, abbr=False):
 
     :param abbr: if `True`, remove leading spaces. Default: `False`.
     """
-    dt = timedelta(seconds=t)
-    days = dt.days
-    secs = dt.seconds
-    hrs, remainder = divmod(secs, 3600)
-    mins, secs = divmod(remainder, 60)
-    micros = dt.microseconds
-    s = f'{days:3d}d' if days > 0 else ' ' * 5
-    s += f'{hrs:2d}h' if hrs > 0 else ' ' * 3
-    s += f'{mins:2d}m' if mins > 0 else ' ' * 3
-    s += f'{secs:2d}.{micros:06d}s'
+    # Split off the fractional seconds first, so that rounding to the nearest
+    # microsecond matches `timedelta(seconds=t)` without constructing one
+    secs, frac = divmod(t, 1)
+    secs = int(secs)
+    micros = round(frac * 1e6)
+    if micros == 1000000:
+        secs += 1
+        micros = 0
+    mins, secs = divmod(secs, 60)
+    hrs, mins = divmod(mins, 60)
+    days, hrs = divmod(hrs, 24)
+    s = '%s%s%s%2d.%06ds' % (
+        '%3dd' % days if days > 0 else '     ',
+        '%2dh' % hrs if hrs > 0 else '   ',
+        '%2dm' % mins if mins > 0 else '   ',
+        secs,
+        micros,
+    )
     return s.lstrip() if abbr else s
 
 
+# Source for the wrappers generated by `Timer.wrap()`. Each template defines a
+# factory, so that the helpers are bound as closure variables rather than
+# looked up on every call. The timing is equivalent to `with Timer(_tag)`, but
+# without creating a Timer instance on every call. On the importing thread, the
+# pure-Python wrappers update the tag's [total_ns, calls] entry directly, which
+# is registered in `Timer.stats_map` when the function is decorated.
+_PY_WRAPPER_TEMPLATE = """\
+def make_wrapper(func, _tag, _entry, _pc, _add_thread):
+    def wrapped_func({params}):
+        t0 = _pc()
+        try:
+            return func({args})
+        finally:
+            dt = _pc() - t0
+            if _get_ident() == _OWNER_IDENT:
+                _entry[0] += dt
+                _entry[1] += 1
+            else:
+                _add_thread(_tag, dt)
+    return wrapped_func
+"""
+_HIST_WRAPPER_TEMPLATE = """\
+def make_wrapper(func, _tag, _entry, _pc, _add_thread, _ring_map, _record):
+    def wrapped_func({params}):
+        t0 = _pc()
+        try:
+            return func({args})
+        finally:
+            dt = _pc() - t0
+            if _get_ident() == _OWNER_IDENT:
+                _entry[0] += dt
+                _entry[1] += 1
+                _record(_ring_map, _tag, dt)
+            else:
+                _add_thread(_tag, dt, True)
+    return wrapped_func
+"""
+_C_WRAPPER_TEMPLATE = """\
+def make_wrapper(func, _tag, _stats_map, _enter, _exit, _thread_maps):
+    def wrapped_func({params}):
+        if _get_ident() == _OWNER_IDENT:
+            m = _stats_map
+        else:
+            m = _thread_maps()[0]
+        t0 = _enter()
+        try:
+            return func({args})
+        finally:
+            _exit(m, _tag, t0)
+    return wrapped_func
+"""
+# Used for `Timer.wrap(jit=True)` while timers are disabled, to call the
+# compiled function without timing it
+_UNTIMED_WRAPPER_TEMPLATE = """\
+def make_wrapper(func):
+    def wrapped_func({params}):
+        return func({args})
+    return wrapped_func
+"""
+# Names used inside the templates, which must not be shadowed by parameters
+_RESERVED_NAMES = {
+    'make_wrapper', 'wrapped_func', 'func', '_tag', '_entry', '_stats_map', '_pc',
+    '_enter', '_exit', '_add_thread', '_ring_map', '_record', '_thread_maps',
+    '_get_ident', '_OWNER_IDENT', 't0', 'dt', 'm'
+}
+_GENERIC_SIGNATURE = ('*args, **kwargs', '*args, **kwargs')
+
+
+def _wrapper_signature(func):
+    """
+    Return the parameter list and call arguments for a wrapper around `func`
+
+    Wrappers copy the exact signature of `func` where possible, which avoids
+    packing the arguments into a tuple and dict on every call. Signatures with
+    defaults, variadic or positional-only parameters get a generic
+    `*args, **kwargs` wrapper instead.
+    """
+    try:
+        sig = inspect.signature(func, follow_wrapped=False)
+    except (TypeError, ValueError):
+        return _GENERIC_SIGNATURE
+    params = []
+    args = []
+    for name, param in sig.parameters.items():
+        if param.default is not param.empty or name in _RESERVED_NAMES:
+            return _GENERIC_SIGNATURE
+        if param.kind == param.POSITIONAL_OR_KEYWORD:
+            params.append(name)
+            args.append(name)
+        elif param.kind == param.KEYWORD_ONLY:
+            if '*' not in params:
+                params.append('*')
+            params.append(name)
+            args.append(f'{name}={name}')
+        else:
+            return _GENERIC_SIGNATURE
+    return ', '.join(params), ', '.join(args)
+
+
+def _make_wrapper(func, tag, stats_map, ring_map=None, wrapped=None):
+    """
+    Generate a function that calls `func` and records its duration under `tag`
+
+    `tag` must already have an entry in `stats_map`. If `ring_map` is given,
+    each duration is also written to the tag's ring buffer. The wrapper copies
+    the signature and metadata of `wrapped`, which defaults to `func`.
+    """
+    if wrapped is None:
+        wrapped = func
+    params, args = _wrapper_signature(wrapped)
+    if ring_map is not None:
+        source = _HIST_WRAPPER_TEMPLATE.format(params=params, args=args)
+        helpers = (tag, stats_map[tag], time.perf_counter_ns, _add_thread_duration, ring_map,
+                   _record_duration)
+    elif probe_exit is not None:
+        source = _C_WRAPPER_TEMPLATE.format(params=params, args=args)
+        helpers = (tag, stats_map, probe_enter, probe_exit, _thread_maps)
+    else:
+        source = _PY_WRAPPER_TEMPLATE.format(params=params, args=args)
+        helpers = (tag, stats_map[tag], time.perf_counter_ns, _add_thread_duration)
+    namespace = {'_get_ident': _get_ident, '_OWNER_IDENT': _OWNER_IDENT}
+    exec(compile(source, '<timer.wrap>', 'exec'), namespace)
+    wrapped_func = namespace['make_wrapper'](func, *helpers)
+    return wraps(wrapped)(wrapped_func)
+
+
+def _replace_func(wrapped_func, func):
+    """
+    Make a wrapper generated by `_make_wrapper()` call `func` from now on
+    """
+    index = wrapped_func.__code__.co_freevars.index('func')
+    wrapped_func.__closure__[index].cell_contents = func
+
+
+def _jit(func, on_first_call):
+    """
+    Compile `func` with Numba in nopython mode, if possible
+
+    Returns `func` unchanged (with a warning) if Numba is not installed.
+    Otherwise, returns a function for the first call, which compiles `func`
+    and passes the result to `on_first_call`; the caller should call that
+    directly from then on. If compilation fails, `on_first_call` gets the
+    uncompiled `func` instead. Compiled code is cached on disk, unless `func`
+    has no source file.
+    """
+    try:
+        import numba
+        from numba.core.errors import NumbaError
+    except ImportError:
+        warnings.warn('numba is not installed; timing the uncompiled function', stacklevel=3)
+        return func
+    try:
+        target = numba.njit(cache=True)(func)
+    except RuntimeError:
+        # Functions without a source file (e.g. from `python -c` or the REPL)
+        # can't be cached on disk
+        target = numba.njit(func)
+
+    @wraps(func)
+    def first_call(*args, **kwargs):
+        try:
+            result = target(*args, **kwargs)
+        except NumbaError as e:
+            warnings.warn(f'could not compile {func.__qualname__} with numba; '
+                          f'using the uncompiled function instead ({type(e).__name__})',
+                          stacklevel=3)
+            on_first_call(func)
+            return func(*args, **kwargs)
+        on_first_call(target)
+        return result
+
+    return first_call
+
+
+def _jit_untimed(func):
+    """
+    Compile `func` with Numba like `Timer.wrap(jit=True)`, but without timing it
+
+    The returned wrapper has the same fallbacks as `_jit()`, and calls the
+    compiled function directly after the first call.
+    """
+    target = _jit(func, lambda compiled: _replace_func(wrapped_func, compiled))
+    if target is func:
+        return func
+    params, args = _wrapper_signature(func)
+    source = _UNTIMED_WRAPPER_TEMPLATE.format(params=params, args=args)
+    namespace = {}
+    exec(compile(source, '<timer.wrap>', 'exec'), namespace)
+    wrapped_func = namespace['make_wrapper'](target)
+    return wraps(func)(wrapped_func)
+
+
+def _record_duration(ring_map, tag, dt):
+    """
+    Write a duration (in nanoseconds) into the ring buffer for `tag`
+    """
+    ring = ring_map.get(tag)
+    if ring is None:
+        ring = ring_map[tag] = [array('q', bytes(8 * Timer._ring_capacity)), 0]
+    buf = ring[0]
+    buf[ring[1] % len(buf)] = dt
+    ring[1] += 1
+
+
+class _ThreadSentinel:
+    """
+    Kept in a thread's locals, so that it is freed when the thread ends
+    """
+    __slots__ = ('__weakref__',)
+
+
+def _ring_samples(ring):
+    """
+    Return the durations in a ring buffer, from oldest to newest
+    """
+    buf, count = ring
+    n = len(buf)
+    if count <= n:
+        return buf[:count]
+    # The buffer has wrapped, so the oldest sample is the next to be overwritten
+    i = count % n
+    return buf[i:] + buf[:i]
+
+
+def _thread_maps():
+    """
+    Return the (stats_map, ring_map) pair of the current thread, creating it on first use
+
+    Only used on threads other than the one that imported timer.
+    """
+    try:
+        return _local.maps
+    except AttributeError:
+        maps = _local.maps = ({}, {})
+        sentinel = _local.sentinel = _ThreadSentinel()
+        key = id(sentinel)
+        with _thread_maps_lock:
+            _live_thread_maps[key] = maps
+        finalize(sentinel, _retire_thread_maps, key)
+        return maps
+
+
+def _retire_thread_maps(key):
+    """
+    Merge the maps of a thread that has ended into `_finished_maps`
+    """
+    finished_stats, finished_rings = _finished_maps
+    with _thread_maps_lock:
+        stats_map, ring_map = _live_thread_maps.pop(key)
+        for tag, (total_ns, calls) in stats_map.items():
+            s = finished_stats.get(tag)
+            if s is None:
+                finished_stats[tag] = [total_ns, calls]
+            else:
+                s[0] += total_ns
+                s[1] += calls
+        for tag, ring in ring_map.items():
+            # In time order, so that the newest samples are kept if the
+            # shared ring buffer overflows
+            for dt in _ring_samples(ring):
+                _record_duration(finished_rings, tag, dt)
+
+
+def _all_maps():
+    """
+    Return the (stats_map, ring_map) pairs of the importing thread, of the
+    finished threads and of each live thread
+
+    Must be called with `_thread_maps_lock` held, so that a thread that ends
+    meanwhile isn't counted twice.
+    """
+    return [(Timer.stats_map, Timer.ring_map), _finished_maps] + list(_live_thread_maps.values())
+
+
+def _add_thread_duration(tag, dt, histogram=False):
+    """
+    Record a duration (in nanoseconds) in the current thread's maps
+
+    :param histogram: if `True`, also write it to the thread's ring buffer
+    """
+    stats_map, ring_map = _thread_maps()
+    s = stats_map.get(tag)
+    if s is None:
+        stats_map[tag] = [dt, 1]
+    else:
+        s[0] += dt
+        s[1] += 1
+    if histogram:
+        _record_duration(ring_map, tag, dt)
+
+
+def _merged_stats():
+    """
+    Combine the maps of all threads into a single map
+
+    The result maps each tag to a [total_ns, calls, samples] list, where
+    `samples` lists the durations in the tag's ring buffers, or is `None` if
+    it has none.
+    """
+    merged = {}
+    with _thread_maps_lock:
+        for thread_stats, thread_rings in _all_maps():
+            # Copy first, since other threads may add tags while we iterate
+            for tag, (total_ns, calls) in thread_stats.copy().items():
+                s = merged.get(tag)
+                if s is None:
+                    merged[tag] = [total_ns, calls, None]
+                else:
+                    s[0] += total_ns
+                    s[1] += calls
+            for tag, ring in thread_rings.copy().items():
+                s = merged.setdefault(tag, [0, 0, None])
+                if s[2] is None:
+                    s[2] = []
+                s[2].extend(_ring_samples(ring))
+    return merged
+
+
+def _percentiles(samples, qs):
+    """
+    Return the nearest-rank percentiles (in seconds) of a list of durations
+    """
+    samples = sorted(samples)
+    n = len(samples)
+    return [samples[max(math.ceil(q / 100 * n) - 1, 0)] * 1e-9 for q in qs]
+
+
 class Timer:
     """
     Timer class for profiling code blocks and functions
@@ -56,38 +420,119 @@ class Timer:
     tag, but it accepts an optional tag argument if you'd like to override
     this with your own identifier.
 
+    After a `with` block, the timer holds the block's duration as
+    `elapsed_ns` (integer nanoseconds) and `elapsed` (seconds):
+
+    ```
+    with Timer('my_func') as t:
+        func()
+    print(t.elapsed)
+    ```
+
     The timer module will attempt to automatically print statistics at the end
-    of program execution. To print manually, use `Timer.stats()`.
+    of program execution, if any timers were used. To print manually, use
+    `Timer.stats()`.
     """
-    timers = defaultdict(float)
-    counters = defaultdict(int)
-    _startup_time = time.time()
+    __slots__ = ('field_name', 'start', 'elapsed_ns')
+
+    # Maps each tag to a mutable [total_ns, calls] pair, so that recording a
+    # call only needs a single dict lookup. Decorated functions register their
+    # tag when decorated, and keep a reference to its pair.
+    stats_map = {}
+    # Maps each tag to a [durations, calls] pair when histograms are enabled,
+    # where `durations` holds the most recent durations (in nanoseconds)
+    ring_map = {}
+    _ring_capacity = 0
+    _startup_time = time.perf_counter_ns()
 
     def __init__(self, tag):
         self.field_name = tag
 
     def __enter__(self):
-        self.start = time.time()
+        self.start = time.perf_counter_ns()
         return self
 
     def __exit__(self, *args):
-        end = time.time()
-        self.duration = end - self.start
-        self.timers[self.field_name] += self.duration
-        self.counters[self.field_name] += 1
+        self.elapsed_ns = time.perf_counter_ns() - self.start
+        if _get_ident() != _OWNER_IDENT:
+            _add_thread_duration(self.field_name, self.elapsed_ns)
+            return
+        s = self.stats_map.get(self.field_name)
+        if s is None:
+            self.stats_map[self.field_name] = [self.elapsed_ns, 1]
+        else:
+            s[0] += self.elapsed_ns
+            s[1] += 1
+
+    @property
+    def elapsed(self):
+        """
+        Duration (in seconds) of the last `with` block timed by this timer
+        """
+        return self.elapsed_ns * 1e-9
 
     @classmethod
     def duration(cls):
-        return time.time() - cls._startup_time
+        """
+        Total time (in seconds) since the timer module was imported or reset
+        """
+        return (time.perf_counter_ns() - cls._startup_time) * 1e-9
+
+    @classmethod
+    def total_ns(cls, tag):
+        """
+        Total time (in integer nanoseconds) recorded under `tag`, across all threads
+        """
+        total = 0
+        with _thread_maps_lock:
+            for stats_map, _ in _all_maps():
+                entry = stats_map.get(tag)
+                if entry is not None:
+                    total += entry[0]
+        return total
 
     @classmethod
     def reset(cls):
         """
-        Delete all timers and reset stats
+        Reset the stats of all timers to zero
         """
-        cls.timers = defaultdict(float)
-        cls.counters = defaultdict(int)
-        cls._startup_time = time.time()
+        # Zero the entries in place, since decorated functions hold references
+        # to them. Tags without calls are left out of `stats()`.
+        with _thread_maps_lock:
+            for stats_map, ring_map in _all_maps():
+                for entry in stats_map.copy().values():
+                    entry[0] = entry[1] = 0
+                ring_map.clear()
+        cls._startup_time = time.perf_counter_ns()
+
+    @classmethod
+    def enable_histogram(cls, capacity=4096):
+        """
+        Keep the most recent durations of each tag, and print their percentiles
+
+        Once enabled, `with Timer(...)` blocks and functions decorated
+        afterwards also store their last `capacity` durations in a
+        preallocated buffer, and `Timer.stats()` gains `p50`, `p95` and `p99`
+        columns. Functions decorated before this is called only record totals,
+        so call it before importing the code you want to time.
+
+        Each thread keeps its own buffers, except that threads which have
+        ended share a single buffer per tag. The percentiles combine all of
+        these buffers, so they are weighted towards the importing thread and
+        the threads still running, each of which can hold up to `capacity`
+        durations per tag.
+
+        :param capacity: the number of durations to keep per tag
+        """
+        if not _ENABLED:
+            return
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        cls._ring_capacity = capacity
+        with _thread_maps_lock:
+            for _, ring_map in _all_maps():
+                ring_map.clear()
+        cls.__exit__ = _histogram_exit
 
     @classmethod
     def stats(cls, csv=False, float_precision=6):
@@ -95,7 +540,8 @@ class Timer:
         Print timer statistics
 
         The timer module will attempt to automatically call this function end
-        of program execution, but it can also be called manually.
+        of program execution (unless no timers were used), but it can also be
+        called manually.
 
         :param csv:             print results as comma separated values
                                 instead of table
@@ -124,22 +570,34 @@ class Timer:
         - `rate`: the effective rate of calls per second
         - `calls`: the total number of calls
 
+        Rows are listed in the order the tags were first seen: decorated
+        functions when they are decorated, and `with` blocks on their first
+        use.
+
+        If `Timer.enable_histogram()` was called, the `p50`, `p95` and `p99`
+        columns show percentiles of the most recent durations for each tag.
+
         The stats are global, so you can `import timer` wherever you need it
-        and the stats will print for all timers. The total time since the
-        `timer` module was first imported is displayed at the bottom of the
-        table.
+        and the stats will print for all timers, combined across threads. The
+        total time since the `timer` module was first imported is displayed at
+        the bottom of the table.
         """
         total_time = cls.duration()
+        stats_map = _merged_stats()
         headers = ['tag', 'frac', 'time', 'percall', 'rate', 'calls']
+        percentiles = (50, 95, 99)
+        if cls._ring_capacity:
+            headers += [f'p{q}' for q in percentiles]
         rows = []
-        if csv:
-            print(*headers, sep=', ')
-        for field_name in cls.timers.keys():
-            cumulative_time = cls.timers[field_name]
-            frac = cumulative_time / total_time
-            calls = cls.counters[field_name]
+        # Multiply by the reciprocal, rather than dividing once per tag
+        inv_total = 1 / total_time if total_time else 0.0
+        for field_name, (total_ns, calls, samples) in stats_map.items():
+            if not calls:
+                continue
+            cumulative_time = total_ns * 1e-9
+            frac = cumulative_time * inv_total
             time_per_call = cumulative_time / calls
-            iters_per_sec = 'NaN' if cumulative_time == 0 else (calls / cumulative_time)
+            iters_per_sec = math.nan if cumulative_time == 0 else calls / cumulative_time
             row = [
                 field_name,
                 frac,
@@ -148,27 +606,58 @@ class Timer:
                 iters_per_sec,
                 calls,
             ]
-            if csv:
-                print(*row, sep=', ')
-            else:
-                rows.append(row)
-
-        if not csv:
+            if cls._ring_capacity:
+                if samples is None:
+                    row += [''] * len(percentiles)
+                else:
+                    row += [time2str(p) for p in _percentiles(samples, percentiles)]
+            rows.append(row)
+
+        # Write all output at once, rather than one line at a time
+        if csv:
+            lines = [', '.join(map(str, row)) for row in [headers] + rows]
+        else:
+            # Imported here, since only the table output needs it
+            from tabulate import tabulate
             table_str = tabulate(rows,
                                  headers=headers,
                                  floatfmt=f'.{float_precision}f',
-                                 colalign=(['left'] + ['right'] * 5))
-            final_row = table_str.split('\n')[-1]
-            print('-' * len(final_row))
-            print(table_str)
-            print('-' * len(final_row))
-            print(f'Total time: {time2str(total_time, abbr=True)}')
-            print('-' * len(final_row))
-
-    def wrap(tag=None):
+                                 colalign=(['left'] + ['right'] * (len(headers) - 1)))
+            # Rows with empty trailing columns are shorter, so use the widest
+            separator = '-' * max(map(len, table_str.split('\n')))
+            lines = [
+                separator,
+                table_str,
+                separator,
+                f'Total time: {time2str(total_time, abbr=True)}',
+                separator,
+            ]
+        sys.stdout.write('\n'.join(lines) + '\n')
+
+    def wrap(tag=None, jit=False):
         """
         Generates a function decorator for timing a function, with an optional tag argument
+
+        Tags are used as dictionary keys on every call, so they should be short
+        strings. They are interned when the decorator is applied.
+
+        Decorating the same function with the same tag again returns the same
+        wrapper, and decorating a wrapper with its own tag returns it
+        unchanged, so that calls are never counted twice.
+
+        :param jit: if `True`, compile the function with `numba.njit(cache=True)`
+                    before timing it. Numba compiles on the first call with each
+                    new combination of argument types, so those calls include
+                    the compilation time (unless it was cached by an earlier
+                    run). Without Numba, or if the function can't be compiled
+                    on its first call, the uncompiled function is timed
+                    instead. Compilation errors for argument types first seen
+                    after that are raised as usual. Functions are still
+                    compiled while timers are disabled.
         """
+        if not _ENABLED:
+            # Keep compiling with Numba, even though nothing is timed
+            return _jit_untimed if jit else lambda func: func
 
         def new_decorator(func):
             if tag is not None:
@@ -178,15 +667,58 @@ class Timer:
                     _tag = func.__qualname__
                 except AttributeError:
                     _tag = func.__name__
-
-            @wraps(func)
-            def wrapped_func(*args, **kwargs):
-                with Timer(_tag):
-                    return func(*args, **kwargs)
-
+            if isinstance(_tag, str):
+                _tag = sys.intern(_tag)
+            if getattr(func, '__timer_tag__', None) == _tag:
+                return func
+            key = (_tag, func, jit, bool(Timer._ring_capacity))
+            try:
+                return _wrap_cache[key]
+            except (KeyError, TypeError):
+                # TypeError: the tag or function is unhashable
+                pass
+            target = func
+            if jit:
+                target = _jit(func, lambda compiled: _replace_func(wrapped_func, compiled))
+
+            Timer.stats_map.setdefault(_tag, [0, 0])
+            ring_map = Timer.ring_map if Timer._ring_capacity else None
+            wrapped_func = _make_wrapper(target, _tag, Timer.stats_map, ring_map, wrapped=func)
+            wrapped_func.__timer_tag__ = _tag
+            try:
+                _wrap_cache[key] = wrapped_func
+            except TypeError:
+                pass
             return wrapped_func
 
         return new_decorator
 
 
-atexit.register(Timer.stats)
+_totals_exit = Timer.__exit__
+
+
+def _histogram_exit(self, *args):
+    _totals_exit(self, *args)
+    if _get_ident() == _OWNER_IDENT:
+        ring_map = Timer.ring_map
+    else:
+        ring_map = _thread_maps()[1]
+    _record_duration(ring_map, self.field_name, self.elapsed_ns)
+
+
+def _stats_at_exit():
+    """
+    Print timer statistics, unless no calls were recorded
+    """
+    with _thread_maps_lock:
+        used = any(entry[1] for stats_map, _ in _all_maps() for entry in stats_map.copy().values())
+    if used:
+        Timer.stats()
+
+
+if _ENABLED:
+    atexit.register(_stats_at_exit)
+else:
+    # Leave the `with Timer(...)` form in place, but skip the timing
+    Timer.__enter__ = lambda self: self
+    Timer.__exit__ = lambda self, *args: None